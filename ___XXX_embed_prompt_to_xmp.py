@@ -6,9 +6,11 @@ This is the reverse operation of extracting XMP data to txt files.
 Writes txt content to XMP:Description and XMP:Title fields.
 """
 import os
+import queue
 import sys
 import subprocess
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
@@ -26,28 +28,95 @@ def get_image_files(folder_path: Path, extensions: tuple = (".png", ".jpg", ".jp
     return sorted(set(image_files))
 
 
-def embed_xmp_to_image(image_path: Path, text_content: str) -> bool:
+def _escape_value(text: str) -> str:
+    """Escape a tag value for exiftool's -ec option (argfile values must fit on one line)."""
+    return text.replace("\\", "\\\\").replace("\r", "\\r").replace("\n", "\\n")
+
+
+def embed_xmp_batch(items: list):
     """
-    Embed text content into image as XMP metadata.
-    Uses exiftool to write XMP:Description and XMP:Title.
+    Embed text content into many images with a single exiftool process.
+    Runs exiftool in -stay_open mode and feeds one -execute command per image,
+    so the Perl interpreter starts once instead of once per file.
+    Yields (image_path, success) in the same order as items.
     """
     try:
-        result = subprocess.run(
-            [
-                "exiftool",
-                "-overwrite_original",
-                f"-XMP:Description={text_content}",
-                f"-XMP:Title={text_content}",
-                "-charset", "iptc=UTF8",
-                str(image_path)
-            ],
-            capture_output=True,
-            text=True
+        proc = subprocess.Popen(
+            ["exiftool", "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding="utf-8",
         )
-        return "1 image files updated" in result.stdout
     except Exception as e:
-        print(f"Error processing {image_path}: {e}")
-        return False
+        print(f"Error starting exiftool: {e}")
+        for image_path, _ in items:
+            yield image_path, False
+        return
+
+    try:
+        for image_path, text_content in items:
+            value = _escape_value(text_content)
+            args = [
+                "-overwrite_original",
+                "-ec",
+                f"-XMP:Description={value}",
+                f"-XMP:Title={value}",
+                "-charset", "iptc=UTF8",
+                str(image_path),
+                "-execute",
+            ]
+            proc.stdin.write("\n".join(args) + "\n")
+            proc.stdin.flush()
+
+            # Read the command output up to the {ready} sentinel
+            output = []
+            for line in proc.stdout:
+                if line.strip() == "{ready}":
+                    break
+                output.append(line)
+            yield image_path, "1 image files updated" in "".join(output)
+    finally:
+        try:
+            proc.stdin.write("-stay_open\nFalse\n")
+            proc.stdin.flush()
+        except OSError:
+            pass
+        proc.wait()
+
+
+def embed_xmp_parallel(items: list, workers: int):
+    """
+    Spread items over several persistent exiftool processes, one per worker thread.
+    Yields (image_path, success) as each image finishes (completion order).
+    """
+    results = queue.Queue()
+
+    def run(chunk):
+        done = 0
+        try:
+            for result in embed_xmp_batch(chunk):
+                results.put(result)
+                done += 1
+        except Exception as e:
+            print(f"Error in exiftool worker: {e}")
+        for image_path, _ in chunk[done:]:
+            results.put((image_path, False))
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for i in range(workers):
+            ex.submit(run, items[i::workers])
+        for _ in items:
+            yield results.get()
+
+
+def embed_xmp_to_image(image_path: Path, text_content: str) -> bool:
+    """
+    Embed text content into image as XMP metadata.
+    Uses exiftool to write XMP:Description and XMP:Title.
+    """
+    return all(ok for _, ok in embed_xmp_batch([(image_path, text_content)]))
 
 
 def main():
@@ -95,10 +164,11 @@ def main():
         print("No image files found.")
         sys.exit(1)
 
-    # Process each image
+    # Collect images with a prompt file
     processed = 0
     skipped_no_prompt = 0
     failed = 0
+    items = []
 
     for image_file in image_files:
         # Find corresponding txt file
@@ -117,8 +187,12 @@ def main():
             skipped_no_prompt += 1
             continue
 
-        # Embed XMP data
-        if embed_xmp_to_image(image_file, text_content):
+        items.append((image_file, text_content))
+
+    # Embed XMP data (one persistent exiftool process per worker)
+    workers = max(1, min(len(items), os.cpu_count() or 1))
+    for image_file, ok in embed_xmp_parallel(items, workers):
+        if ok:
             processed += 1
             print(f"✓ {processed}: {image_file.name}")
         else:
@@ -7,37 +7,44 @@ import os
 import re
 import sys
 import html
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from PIL import Image
 
 
+# Pattern: <dc:description>...<rdf:li xml:lang='x-default'>CONTENT</rdf:li>...</dc:description>
+_DESC_PATTERN = r"<dc:description>.*?<rdf:li[^>]*>(.+?)</rdf:li>.*?</dc:description>"
+_TITLE_PATTERN = r"<dc:title>.*?<rdf:li[^>]*>(.+?)</rdf:li>.*?</dc:title>"
+
+# Compiled once; bytes variants search raw XMP without decoding the whole packet
+_XMP_PATTERNS_STR = (
+    re.compile(_DESC_PATTERN, re.DOTALL),
+    re.compile(_TITLE_PATTERN, re.DOTALL),
+)
+_XMP_PATTERNS_BYTES = (
+    re.compile(_DESC_PATTERN.encode(), re.DOTALL),
+    re.compile(_TITLE_PATTERN.encode(), re.DOTALL),
+)
+
+
 def extract_xmp_description(xmp_data: str) -> str:
     """
     Extract the description text from XMP data.
-    Looks for dc:description content.
+    Looks for dc:description content, then falls back to dc:title.
     """
     if isinstance(xmp_data, bytes):
-        xmp_data = xmp_data.decode("utf-8", errors="ignore")
-
-    # Try to find dc:description content
-    # Pattern: <dc:description>...<rdf:li xml:lang='x-default'>CONTENT</rdf:li>...</dc:description>
-    pattern = r"<dc:description>.*?<rdf:li[^>]*>(.+?)</rdf:li>.*?</dc:description>"
-    match = re.search(pattern, xmp_data, re.DOTALL)
-
-    if match:
-        content = match.group(1).strip()
-        # Unescape HTML entities (e.g., &lt; -> <, &gt; -> >)
-        content = html.unescape(content)
-        return content
-
-    # Alternative: try dc:title if dc:description not found
-    pattern = r"<dc:title>.*?<rdf:li[^>]*>(.+?)</rdf:li>.*?</dc:title>"
-    match = re.search(pattern, xmp_data, re.DOTALL)
-
-    if match:
-        content = match.group(1).strip()
-        content = html.unescape(content)
-        return content
+        patterns = _XMP_PATTERNS_BYTES
+    else:
+        patterns = _XMP_PATTERNS_STR
+
+    for regex in patterns:
+        match = regex.search(xmp_data)
+        if match:
+            content = match.group(1)
+            if isinstance(content, bytes):
+                content = content.decode("utf-8", errors="ignore")
+            # Unescape HTML entities (e.g., &lt; -> <, &gt; -> >)
+            return html.unescape(content.strip())
 
     return ""
 
@@ -73,6 +80,31 @@ def extract_xmp_from_image(image_path: Path) -> str:
         return ""
 
 
+def process_image(image_file: Path, overwrite: bool) -> str:
+    """
+    Extract XMP from one image and write the .txt file next to it.
+    Returns "created", "skipped" (txt exists) or "no_xmp".
+    """
+    # Create prompt file path with same name (.txt)
+    prompt_file = image_file.with_suffix(".txt")
+
+    # Check if txt file already exists
+    if prompt_file.exists() and not overwrite:
+        return "skipped"
+
+    # Extract XMP data
+    xmp_content = extract_xmp_from_image(image_file)
+
+    if not xmp_content:
+        return "no_xmp"
+
+    # Write prompt file
+    with open(prompt_file, "w", encoding="utf-8") as f:
+        f.write(xmp_content)
+
+    return "created"
+
+
 def main():
     # Parse arguments
     if len(sys.argv) < 2:
@@ -115,30 +147,22 @@ def main():
     skipped = 0
     no_xmp = 0
 
-    for image_file in image_files:
-        # Create prompt file path with same name (.txt)
-        prompt_file = image_file.with_suffix(".txt")
-
-        # Check if txt file already exists
-        if prompt_file.exists() and not overwrite:
-            print(f"Skipping (txt exists): {image_file.name}")
-            skipped += 1
-            continue
-
-        # Extract XMP data
-        xmp_content = extract_xmp_from_image(image_file)
-
-        if not xmp_content:
-            print(f"No XMP data found: {image_file.name}")
-            no_xmp += 1
-            continue
-
-        # Write prompt file
-        with open(prompt_file, "w", encoding="utf-8") as f:
-            f.write(xmp_content)
-
-        print(f"✓ Created: {prompt_file.name}")
-        processed += 1
+    workers = min(32, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(process_image, f, overwrite): f for f in image_files}
+        for fut in as_completed(futures):
+            image_file = futures[fut]
+            status = fut.result()
+
+            if status == "skipped":
+                print(f"Skipping (txt exists): {image_file.name}")
+                skipped += 1
+            elif status == "no_xmp":
+                print(f"No XMP data found: {image_file.name}")
+                no_xmp += 1
+            else:
+                print(f"✓ Created: {image_file.with_suffix('.txt').name}")
+                processed += 1
 
     print()
     print("=" * 50)
@@ -12,16 +12,31 @@ Danbooru Favorites Downloader (API Key版)
   python danbooru_fav_downloader.py --skip-download
   python danbooru_fav_downloader.py --skip-resize
 """
+import hashlib
 import json
+import mmap
+import os
+import shutil
+import struct
 import sys
+import threading
 import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urlencode
 
 import requests
-import numpy as np
+from requests.adapters import HTTPAdapter
 from PIL import Image
 
+try:
+    import orjson
+except ImportError:  # orjson が無ければ標準の json を使う
+    orjson = None
+
 # ============================================================
 # 設定 — ここを自分の情報に書き換える
 # ============================================================
@@ -33,19 +48,70 @@ PER_PAGE = 200  # Danbooru API max
 SCRIPT_DIR = Path(__file__).parent.resolve()
 OUTPUT_DIR = SCRIPT_DIR / "danbooru_output_fav"
 JSON_FILE = OUTPUT_DIR / "_posts_metadata.json"
+API_CACHE_FILE = OUTPUT_DIR / "_api_cache.json"  # API ページの ETag キャッシュ
 
 BASE_URL = "https://danbooru.donmai.us"
 AUTH = (DANBOORU_LOGIN, DANBOORU_API_KEY)
 
+DOWNLOAD_WORKERS = 8  # 同時ダウンロード数
+RATE_LIMIT = 10  # Danbooru の制限: 10 req/s
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # ダウンロード時の書き込み単位
+NUM_WORKERS = min(32, (os.cpu_count() or 1) * 2)  # リサイズ / XMP の並列数
+RESIZE_WORKERS = os.cpu_count() or 1  # リサイズ: デコードスレッド数 (CPU 処理)
+PIPELINE_DEPTH = 4  # リサイズ: 同時にメモリに載せる画像の上限 (= 保存スレッド数)
+
 
 # ============================================================
-# API で全ページ取得
+# HTTP Session (API / 画像ダウンロードで共有)
 # ============================================================
-def fetch_all_posts() -> list:
-    """全 favorite 投稿を取得（重複排除・ページネーション対応）"""
+@lru_cache(maxsize=None)
+def _get_session() -> requests.Session:
+    """共有 Session を返す (ワーカー数ぶんの keep-alive 接続をプール)"""
     session = requests.Session()
-    session.auth = AUTH
     session.headers["User-Agent"] = "DanbooruFavDL/1.0"
+    adapter = HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _json_loads(data: bytes):
+    """JSON をパース (orjson があれば使う)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dump(obj, path: Path, indent: bool = False):
+    """JSON をファイルに書き出す (orjson があれば使う)"""
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=option))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, ensure_ascii=False, indent=2 if indent else None)
+
+
+def _load_json_dict(path: Path) -> dict:
+    """JSON ファイルを dict として読む (無い・壊れている場合は空)"""
+    try:
+        return _json_loads(path.read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+
+# ============================================================
+# API で全ページ取得
+# ============================================================
+def fetch_all_posts() -> list:
+    """
+    全 favorite 投稿を取得（重複排除・ページネーション対応）
+    前回の ETag / Last-Modified で条件付き GET し、304 ならキャッシュを使う。
+    """
+    session = _get_session()
+    cache = _load_json_dict(API_CACHE_FILE)
+    new_cache = {}
 
     all_posts = []
     seen_ids = set()
@@ -56,12 +122,33 @@ def fetch_all_posts() -> list:
         url = f"{BASE_URL}/posts.json?{urlencode(params)}"
         print(f"  Page {page} ... ", end="", flush=True)
 
-        resp = session.get(url)
-        if resp.status_code != 200:
+        headers = {}
+        cached = cache.get(url)
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        resp = session.get(url, auth=AUTH, headers=headers)
+        from_cache = resp.status_code == 304 and cached is not None
+        if from_cache:
+            posts = cached["posts"]
+            new_cache[url] = cached
+        elif resp.status_code != 200:
             print(f"HTTP {resp.status_code}")
             break
+        else:
+            posts = _json_loads(resp.content)
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+            if etag or last_modified:
+                new_cache[url] = {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "posts": posts,
+                }
 
-        posts = resp.json()
         if not posts:
             print("empty -> done!")
             break
@@ -73,12 +160,16 @@ def fetch_all_posts() -> list:
                 all_posts.append(p)
                 new += 1
 
-        print(f"{len(posts)} posts ({new} new)")
+        print(f"{len(posts)} posts ({new} new){' [cached]' if from_cache else ''}")
 
         if len(posts) < PER_PAGE:
             break
         page += 1
-        time.sleep(0.5)  # rate limit: 10 req/s
+        if not from_cache:
+            time.sleep(0.5)  # rate limit: 10 req/s
+
+    if new_cache:
+        _json_dump(new_cache, API_CACHE_FILE)
 
     return all_posts
 
@@ -86,55 +177,53 @@ def fetch_all_posts() -> list:
 # ============================================================
 # メタデータ整理
 # ============================================================
-ALLOWED_EXT = {"jpg", "jpeg", "png", "webp", "gif"}
+ALLOWED_EXT = frozenset({"jpg", "jpeg", "png", "webp", "gif"})
+
+# カンマ区切りに変換して保存するタグ列
+TAG_STRING_FIELDS = (
+    "tag_string_artist",
+    "tag_string_character",
+    "tag_string_copyright",
+    "tag_string_general",
+    "tag_string_meta",
+)
+# (API のキー, data-flags に出す名前)
+POST_FLAGS = (
+    ("is_flagged", "flagged"),
+    ("is_pending", "pending"),
+    ("is_deleted", "deleted"),
+)
+
+
+def _make_record(p: dict) -> dict:
+    """投稿 1 件分のレコードを作る"""
+    get = p.get
+    record = {
+        "data-id": p["id"],
+        "data-tags": get("tag_string", "").replace(" ", ", "),
+        "data-rating": get("rating", ""),
+        "data-flags": ", ".join([name for key, name in POST_FLAGS if get(key)]),
+        "data-score": get("score", 0),
+        "data-uploader-id": get("uploader_id", 0),
+        "file_url": get("file_url") or get("large_file_url") or "",
+        "file_ext": get("file_ext", "jpg"),
+        "source": get("source", ""),
+    }
+    for field in TAG_STRING_FIELDS:
+        record[field] = get(field, "").replace(" ", ", ")
+    record["image_width"] = get("image_width", 0)
+    record["image_height"] = get("image_height", 0)
+    record["md5"] = get("md5", "")
+    return record
 
 
 def build_metadata(posts: list) -> list:
     """HTML の data-* 属性に対応する情報を抽出（動画は除外）"""
-    records = []
-    for p in posts:
-        file_ext = p.get("file_ext", "jpg")
-        if file_ext.lower() not in ALLOWED_EXT:
-            continue
-        file_url = p.get("file_url") or p.get("large_file_url") or ""
-        file_ext = p.get("file_ext", "jpg")
-
-        flags = []
-        if p.get("is_flagged"):
-            flags.append("flagged")
-        if p.get("is_pending"):
-            flags.append("pending")
-        if p.get("is_deleted"):
-            flags.append("deleted")
-
-        records.append(
-            {
-                "data-id": p["id"],
-                "data-tags": p.get("tag_string", "").replace(" ", ", "),
-                "data-rating": p.get("rating", ""),
-                "data-flags": ", ".join(flags),
-                "data-score": p.get("score", 0),
-                "data-uploader-id": p.get("uploader_id", 0),
-                "file_url": file_url,
-                "file_ext": file_ext,
-                "source": p.get("source", ""),
-                "tag_string_artist": p.get("tag_string_artist", "").replace(" ", ", "),
-                "tag_string_character": p.get("tag_string_character", "").replace(
-                    " ", ", "
-                ),
-                "tag_string_copyright": p.get("tag_string_copyright", "").replace(
-                    " ", ", "
-                ),
-                "tag_string_general": p.get("tag_string_general", "").replace(
-                    " ", ", "
-                ),
-                "tag_string_meta": p.get("tag_string_meta", "").replace(" ", ", "),
-                "image_width": p.get("image_width", 0),
-                "image_height": p.get("image_height", 0),
-                "md5": p.get("md5", ""),
-            }
-        )
-    return records
+    return [
+        _make_record(p)
+        for p in posts
+        if p.get("file_ext", "jpg").lower() in ALLOWED_EXT
+    ]
 
 
 # ============================================================
@@ -154,108 +243,224 @@ SDXL_RESOLUTIONS = [
 ]
 
 
+# (アスペクト比, 解像度) を事前計算
+_SDXL_ASPECTS = [(rw / rh, (rw, rh)) for rw, rh in SDXL_RESOLUTIONS]
+
+
 def find_closest_sdxl_resolution(w: int, h: int) -> tuple:
     """アスペクト比が最も近い SDXL 解像度を返す"""
     aspect = w / h
-    best = None
-    best_diff = float("inf")
-    for rw, rh in SDXL_RESOLUTIONS:
-        diff = abs((rw / rh) - aspect)
-        if diff < best_diff:
-            best_diff = diff
-            best = (rw, rh)
-    return best
+    return min(_SDXL_ASPECTS, key=lambda a: abs(a[0] - aspect))[1]
 
 
 def get_average_color(img: Image.Image) -> tuple:
-    """画像の平均色を (R, G, B) で返す"""
-    arr = np.array(img.convert("RGB"))
-    avg = arr.mean(axis=(0, 1)).astype(int)
-    return tuple(avg)
+    """画像の平均色を (R, G, B) で返す (BOX フィルタで 1x1 に縮小)"""
+    # 既に RGB なら convert による全画素のコピーを作らない
+    src = img if img.mode == "RGB" else img.convert("RGB")
+    return src.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
 
 
-def resize_to_sdxl(filepath: Path) -> bool:
+def render_sdxl(filepath: Path):
     """
-    画像を最も近い SDXL 解像度にリサイズ。
+    画像を最も近い SDXL 解像度のキャンバスに描画して返す (保存はしない)。
     - bicubic 補間
     - アスペクト比維持
     - パディングは画像の平均色
+    既にターゲットサイズなら None を返す。
     """
-    try:
-        img = Image.open(filepath).convert("RGB")
-        orig_w, orig_h = img.size
+    # Image.open はヘッダのみ読む (ピクセルのデコードは必要になるまで遅延)
+    with Image.open(filepath) as src:
+        orig_w, orig_h = src.size
         target_w, target_h = find_closest_sdxl_resolution(orig_w, orig_h)
 
-        # 既にターゲットサイズなら skip
+        # 既にターゲットサイズなら skip (デコードしない)
         if orig_w == target_w and orig_h == target_h:
-            return True
+            return None
 
-        # 平均色を取得 (リサイズ前)
-        avg_color = get_average_color(img)
+        img = src.convert("RGB")
 
-        # アスペクト比維持でリサイズ (fit inside target)
-        scale = min(target_w / orig_w, target_h / orig_h)
-        new_w = round(orig_w * scale)
-        new_h = round(orig_h * scale)
-        img_resized = img.resize((new_w, new_h), Image.BICUBIC)
+    # 平均色を取得 (リサイズ前)
+    avg_color = get_average_color(img)
 
-        # 平均色でパディング
-        canvas = Image.new("RGB", (target_w, target_h), avg_color)
-        paste_x = (target_w - new_w) // 2
-        paste_y = (target_h - new_h) // 2
-        canvas.paste(img_resized, (paste_x, paste_y))
+    # アスペクト比維持でリサイズ (fit inside target)
+    scale = min(target_w / orig_w, target_h / orig_h)
+    new_w = round(orig_w * scale)
+    new_h = round(orig_h * scale)
+    img_resized = img.resize((new_w, new_h), Image.Resampling.BICUBIC)
+
+    # 平均色でパディング
+    canvas = Image.new("RGB", (target_w, target_h), avg_color)
+    paste_x = (target_w - new_w) // 2
+    paste_y = (target_h - new_h) // 2
+    canvas.paste(img_resized, (paste_x, paste_y))
+    return canvas
+
+
+def save_image(canvas: Image.Image, filepath: Path):
+    """拡張子に合わせてエンコードし、元ファイルを上書き保存"""
+    ext = filepath.suffix.lower()
+    if ext in (".jpg", ".jpeg"):
+        canvas.save(filepath, "JPEG", quality=95)
+    elif ext == ".png":
+        canvas.save(filepath, "PNG")
+    elif ext == ".webp":
+        canvas.save(filepath, "WEBP", quality=95)
+    else:
+        canvas.save(filepath)
 
-        # 保存 (元ファイルを上書き)
-        ext = filepath.suffix.lower()
-        if ext in (".jpg", ".jpeg"):
-            canvas.save(filepath, "JPEG", quality=95)
-        elif ext == ".png":
-            canvas.save(filepath, "PNG")
-        elif ext == ".webp":
-            canvas.save(filepath, "WEBP", quality=95)
-        else:
-            canvas.save(filepath)
 
+def resize_to_sdxl(filepath: Path) -> bool:
+    """画像を最も近い SDXL 解像度にリサイズして上書き保存"""
+    try:
+        canvas = render_sdxl(filepath)
+        if canvas is not None:
+            save_image(canvas, filepath)
         return True
     except Exception as e:
         print(f"  Resize error {filepath.name}: {e}")
         return False
 
 
+def needs_resize(filepath: Path) -> bool:
+    """ヘッダだけ読んで SDXL 解像度へのリサイズが必要か判定する"""
+    try:
+        with Image.open(filepath) as img:
+            return img.size != find_closest_sdxl_resolution(*img.size)
+    except Exception:
+        # 読めないファイルはリサイズ側でエラーを報告させる
+        return True
+
+
 def resize_all_images(records: list, output_dir: Path) -> int:
-    """全画像を SDXL 解像度にリサイズ"""
-    resized = 0
-    total = 0
+    """
+    全画像を SDXL 解像度にリサイズ。
+    デコード+リサイズと、エンコード+書き込みを別のスレッドプールで
+    パイプライン処理する (画像 N の保存中に N+1 をデコード)。
+    """
+    present = frozenset(os.listdir(output_dir))
+    targets = []
+    up_to_date = 0
     for rec in records:
-        fp = output_dir / f"{rec['data-id']}.{rec['file_ext']}"
-        if not fp.exists():
+        name = f"{rec['data-id']}.{rec['file_ext']}"
+        if name not in present:
             continue
-        total += 1
-        if resize_to_sdxl(fp):
-            resized += 1
-            if resized <= 3 or resized % 20 == 0:
-                img = Image.open(fp)
-                print(f"  Resized [{resized}/{total}] #{rec['data-id']} -> {img.size}")
+        fp = output_dir / name
+        # 既に SDXL 解像度のものはキューに入れない (ヘッダ読みのみ)
+        if not needs_resize(fp):
+            up_to_date += 1
+            continue
+        targets.append((rec, fp))
+    if up_to_date:
+        print(f"  Already SDXL size: {up_to_date}")
+
+    # デコード開始から保存完了までの画像数を PIPELINE_DEPTH に制限し、
+    # スレッド数に関係なくメモリ使用量を一定に抑える
+    slots = threading.Semaphore(PIPELINE_DEPTH)
+
+    def decode(fp):
+        slots.acquire()
+        try:
+            canvas = render_sdxl(fp)
+        except Exception as e:
+            slots.release()
+            print(f"  Resize error {fp.name}: {e}")
+            return False
+        if canvas is None:
+            slots.release()
+            return True
+        return canvas
+
+    def encode(canvas, fp):
+        try:
+            save_image(canvas, fp)
+            return True
+        except Exception as e:
+            print(f"  Resize error {fp.name}: {e}")
+            return False
+        finally:
+            slots.release()
+
+    resized = 0
+    total = len(targets)
+    decoder = ThreadPoolExecutor(max_workers=RESIZE_WORKERS)
+    encoder = ThreadPoolExecutor(max_workers=PIPELINE_DEPTH)
+    with decoder, encoder:
+        pending = {decoder.submit(decode, fp): (rec, fp) for rec, fp in targets}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                rec, fp = pending.pop(fut)
+                result = fut.result()
+                # デコード完了 -> 保存ステージへ
+                if isinstance(result, Image.Image):
+                    pending[encoder.submit(encode, result, fp)] = (rec, fp)
+                    continue
+                if not result:
+                    continue
+                resized += 1
+                if resized <= 3 or resized % 20 == 0:
+                    with Image.open(fp) as img:
+                        print(f"  Resized [{resized}/{total}] #{rec['data-id']} -> {img.size}")
     return resized
 
 
 # ============================================================
 # 画像ダウンロード
 # ============================================================
+class _RateLimiter:
+    """全スレッド共通のレート制限 (1/rate 秒間隔でリクエストを発行)"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _download_one(
+    session: requests.Session, limiter: _RateLimiter, rec: dict, fp: Path
+) -> tuple:
+    """1 枚ダウンロードして (成功したか, ログ文字列) を返す"""
+    # 途中で失敗した時に途切れたファイルが本来の名前で残って次回 skip されないよう、
+    # .part に書いてから置き換える
+    part_path = fp.with_name(fp.name + ".part")
+    try:
+        limiter.wait()
+        with session.get(rec["file_url"], stream=True, timeout=60) as r:
+            if r.status_code != 200:
+                return False, f"HTTP {r.status_code}"
+            # 8 KB 単位の Python ループではなく大きめのバッファで一括コピー
+            r.raw.decode_content = True
+            with open(part_path, "wb") as f:
+                shutil.copyfileobj(r.raw, f, DOWNLOAD_CHUNK_SIZE)
+        os.replace(part_path, fp)
+        size_kb = fp.stat().st_size / 1024
+        return True, f"OK ({size_kb:.0f} KB)"
+    except Exception as e:
+        part_path.unlink(missing_ok=True)
+        return False, f"Error: {e}"
+
+
 def download_images(records: list, output_dir: Path) -> int:
     """原寸画像をダウンロード。ファイル名は {post_id}.{ext}"""
-    session = requests.Session()
-    session.headers["User-Agent"] = "DanbooruFavDL/1.0"
-
+    # ファイルごとの stat() を避けるため、ディレクトリを 1 回だけ列挙
+    present = frozenset(os.listdir(output_dir))
     to_dl = []
     for rec in records:
         if not rec["file_url"]:
             continue
         if rec["file_ext"].lower() not in ALLOWED_EXT:
             continue
-        fp = output_dir / f"{rec['data-id']}.{rec['file_ext']}"
-        if not fp.exists():
-            to_dl.append((rec, fp))
+        name = f"{rec['data-id']}.{rec['file_ext']}"
+        if name not in present:
+            to_dl.append((rec, output_dir / name))
 
     if not to_dl:
         print("  All images already exist.")
@@ -265,27 +470,19 @@ def download_images(records: list, output_dir: Path) -> int:
     downloaded = 0
     failed = 0
 
-    for i, (rec, fp) in enumerate(to_dl, 1):
-        pid = rec["data-id"]
-        print(f"  [{i}/{len(to_dl)}] #{pid}: ", end="", flush=True)
-        try:
-            r = session.get(rec["file_url"], stream=True, timeout=60)
-            if r.status_code == 200:
-                with open(fp, "wb") as f:
-                    for chunk in r.iter_content(8192):
-                        f.write(chunk)
-                size_kb = fp.stat().st_size / 1024
-                print(f"OK ({size_kb:.0f} KB)")
+    session = _get_session()
+    limiter = _RateLimiter(RATE_LIMIT)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        futures = {
+            ex.submit(_download_one, session, limiter, rec, fp): rec for rec, fp in to_dl
+        }
+        for i, fut in enumerate(as_completed(futures), 1):
+            ok, msg = fut.result()
+            print(f"  [{i}/{len(to_dl)}] #{futures[fut]['data-id']}: {msg}")
+            if ok:
                 downloaded += 1
             else:
-                print(f"HTTP {r.status_code}")
                 failed += 1
-        except Exception as e:
-            print(f"Error: {e}")
-            failed += 1
-
-        if i % 10 == 0:
-            time.sleep(0.3)
 
     if failed:
         print(f"  Failed: {failed}")
@@ -329,99 +526,177 @@ def _build_xmp_packet(tags_str: str) -> str:
     return xmp
 
 
+_IOV_MAX = 1024  # writev 1 回あたりのバッファ数上限 (Linux)
+
+
+def _write_parts(f, parts: list):
+    """複数のバッファを結合せずに書き込む (writev でまとめて発行)"""
+    if not hasattr(os, "writev"):  # Windows
+        f.writelines(parts)
+        return
+
+    f.flush()
+    fd = f.fileno()
+    views = [memoryview(p) for p in parts]
+    i = 0
+    while i < len(views):
+        written = os.writev(fd, views[i : i + _IOV_MAX])
+        # 書き込み済みのバッファを進める (部分書き込みに対応)
+        while i < len(views) and written >= len(views[i]):
+            written -= len(views[i])
+            i += 1
+        if written:
+            views[i] = views[i][written:]
+
+
+@contextmanager
+def _rewrite_file(filepath: Path):
+    """一時ファイルに書き出し、成功したら元ファイルと置き換える"""
+    tmp_path = filepath.with_name(filepath.name + ".tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+_XMP_APP1_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+
+
 def _embed_xmp_to_jpeg(filepath: Path, xmp_packet: str) -> bool:
     """JPEG に XMP パケットを埋め込む (APP1 マーカー)"""
     xmp_bytes = xmp_packet.encode("utf-8")
-    xmp_header = b"http://ns.adobe.com/xap/1.0/\x00"
-    app1_data = xmp_header + xmp_bytes
+    app1_data = _XMP_APP1_HEADER + xmp_bytes
     app1_length = len(app1_data) + 2  # +2 for length bytes
+    app1_marker = b"\xff\xe1" + app1_length.to_bytes(2, "big") + app1_data
 
-    with open(filepath, "rb") as f:
-        data = f.read()
-
-    if data[:2] != b"\xff\xd8":
-        return False  # Not JPEG
-
-    # 既存の XMP APP1 セグメントを除去
-    pos = 2
-    new_data = b"\xff\xd8"
-    while pos < len(data):
-        if data[pos : pos + 2] == b"\xff\xe1":
-            seg_len = int.from_bytes(data[pos + 2 : pos + 4], "big")
-            seg_body = data[pos + 4 : pos + 2 + seg_len]
-            if seg_body.startswith(b"http://ns.adobe.com/xap/1.0/\x00"):
-                pos += 2 + seg_len
+    # 先頭の APPn セグメントだけ読み、既存の XMP APP1 をすべて除去
+    with open(filepath, "rb") as src:
+        if src.read(2) != b"\xff\xd8":
+            return False  # Not JPEG
+
+        kept = []
+        while True:
+            head = src.read(4)
+            if len(head) < 4 or head[0] != 0xFF or not 0xE0 <= head[1] <= 0xEF:
+                src.seek(-len(head), 1)
+                break
+            seg_len = int.from_bytes(head[2:4], "big")
+            if seg_len < 2:
+                src.seek(-len(head), 1)
+                break
+            seg_body = src.read(seg_len - 2)
+            if head[1] == 0xE1 and seg_body.startswith(_XMP_APP1_HEADER):
                 continue
-        break
-
-    # 残りのデータ
-    rest = data[pos:]
+            kept.append(head + seg_body)
+        pos = src.tell()
+
+    # SOI + 新しい APP1 + 残りの APPn を書き、画像データはストリームでコピー
+    with _rewrite_file(filepath) as dst, open(filepath, "rb") as src:
+        dst.write(b"\xff\xd8")
+        dst.write(app1_marker)
+        dst.writelines(kept)
+        src.seek(pos)
+        shutil.copyfileobj(src, dst, 1 << 20)
+    return True
 
-    # 新しい APP1 を挿入
-    app1_marker = b"\xff\xe1" + app1_length.to_bytes(2, "big") + app1_data
-    result = b"\xff\xd8" + app1_marker + rest
 
-    with open(filepath, "wb") as f:
-        f.write(result)
-    return True
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_XMP_KEYWORD = b"XML:com.adobe.xmp"
+# 旧実装 (PngInfo.add_text) は Latin-1 に収まると tEXt で書いていたので、
+# 既存 XMP はテキスト系チャンク 3 種すべてから探す
+_PNG_TEXT_CHUNKS = (b"tEXt", b"zTXt", b"iTXt")
 
 
 def _embed_xmp_to_png(filepath: Path, xmp_packet: str) -> bool:
-    """PNG に XMP を iTXt チャンクとして埋め込む"""
-    from PIL import Image as PILImage
-    from PIL.PngImagePlugin import PngInfo
-
-    img = PILImage.open(filepath)
-    meta = PngInfo()
-    meta.add_text("XML:com.adobe.xmp", xmp_packet, zip=False)
-    img.save(filepath, "PNG", pnginfo=meta)
+    """PNG に XMP を iTXt チャンクとして埋め込む (IDAT は再エンコードせずコピー)"""
+    # iTXt: keyword\0 + 圧縮フラグ 0 + 圧縮方式 0 + 言語タグ\0 + 翻訳キーワード\0 + テキスト
+    itxt_data = _PNG_XMP_KEYWORD + b"\x00\x00\x00\x00\x00" + xmp_packet.encode("utf-8")
+    itxt_crc = zlib.crc32(b"iTXt" + itxt_data)
+    itxt_chunk = (
+        len(itxt_data).to_bytes(4, "big")
+        + b"iTXt"
+        + itxt_data
+        + itxt_crc.to_bytes(4, "big")
+    )
+
+    with open(filepath, "rb") as f:
+        if f.read(8) != _PNG_SIGNATURE:
+            return False  # Not PNG
+
+    # チャンク単位でコピー。既存の XMP (tEXt/zTXt/iTXt) は除去し、
+    # IHDR の直後に新しい iTXt を挿入
+    with _rewrite_file(filepath) as dst, open(filepath, "rb") as src:
+        dst.write(src.read(8))
+        while True:
+            head = src.read(8)
+            if len(head) < 8:
+                break
+            chunk_len = int.from_bytes(head[:4], "big")
+            chunk_type = head[4:8]
+            body = src.read(chunk_len + 4)  # data + CRC
+            if chunk_type in _PNG_TEXT_CHUNKS and body.startswith(
+                _PNG_XMP_KEYWORD + b"\x00"
+            ):
+                continue
+            dst.write(head)
+            dst.write(body)
+            if chunk_type == b"IHDR":
+                dst.write(itxt_chunk)
     return True
 
 
+def _webp_chunk_parts(mm: mmap.mmap, xmp_bytes: bytes) -> list:
+    """WEBP 以降のチャンク列を、既存 XMP を除いて新しい XMP を足したバッファのリストで返す"""
+    # チャンク本体はコピーせず mmap のビューで参照
+    view = memoryview(mm)
+    parts = [b"WEBP"]
+    pos = 12
+    while pos + 8 <= len(mm):
+        chunk_id = mm[pos : pos + 4]
+        (chunk_size,) = struct.unpack_from("<I", mm, pos + 4)
+        # パディング (偶数バイト境界)
+        padded_size = chunk_size + (chunk_size % 2)
+        if chunk_id != b"XMP ":
+            chunk_data = view[pos + 8 : pos + 8 + chunk_size]
+            parts.append(chunk_id + len(chunk_data).to_bytes(4, "little"))
+            parts.append(chunk_data)
+            if len(chunk_data) % 2 == 1:
+                parts.append(b"\x00")  # パディング
+        pos += 8 + padded_size
+
+    # 新しい XMP チャンクを追加
+    parts.append(b"XMP " + len(xmp_bytes).to_bytes(4, "little"))
+    parts.append(xmp_bytes)
+    if len(xmp_bytes) % 2 == 1:
+        parts.append(b"\x00")
+    return parts
+
+
 def _embed_xmp_to_webp(filepath: Path, xmp_packet: str) -> bool:
     """WebP に XMP を埋め込む (RIFF チャンク操作)"""
     xmp_bytes = xmp_packet.encode("utf-8")
 
     with open(filepath, "rb") as f:
-        data = f.read()
+        header = f.read(12)
 
     # RIFF/WEBP 形式確認
-    if data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+    if header[:4] != b"RIFF" or header[8:12] != b"WEBP":
         # フォールバック: サイドカー .xmp ファイル
         xmp_path = filepath.with_suffix(".xmp")
         xmp_path.write_text(xmp_packet, encoding="utf-8")
         return True
 
-    # 既存の XMP チャンクを除去
-    pos = 12
-    chunks = []
-    while pos < len(data):
-        if pos + 8 > len(data):
-            break
-        chunk_id = data[pos : pos + 4]
-        chunk_size = int.from_bytes(data[pos + 4 : pos + 8], "little")
-        chunk_data = data[pos + 8 : pos + 8 + chunk_size]
-        # パディング (偶数バイト境界)
-        padded_size = chunk_size + (chunk_size % 2)
-        if chunk_id != b"XMP ":
-            chunks.append((chunk_id, chunk_data))
-        pos += 8 + padded_size
-
-    # 新しい XMP チャンクを追加
-    chunks.append((b"XMP ", xmp_bytes))
-
-    # RIFF を再構築
-    body = b"WEBP"
-    for chunk_id, chunk_data in chunks:
-        size = len(chunk_data)
-        body += chunk_id + size.to_bytes(4, "little") + chunk_data
-        if size % 2 == 1:
-            body += b"\x00"  # パディング
-
-    result = b"RIFF" + len(body).to_bytes(4, "little") + body
-
-    with open(filepath, "wb") as f:
-        f.write(result)
+    # RIFF を再構築 (mmap 上のチャンクを writev でまとめて書き込む)
+    with _rewrite_file(filepath) as dst, open(filepath, "rb") as src:
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            parts = _webp_chunk_parts(mm, xmp_bytes)
+            body_size = sum(len(p) for p in parts)
+            riff_header = b"RIFF" + body_size.to_bytes(4, "little")
+            _write_parts(dst, [riff_header] + parts)
+            del parts  # mmap を閉じる前にビューを解放
     return True
 
 
@@ -443,26 +718,57 @@ def embed_xmp_single(filepath: Path, tags_str: str) -> bool:
     return False
 
 
+XMP_STAMP_NAME = "_xmp_stamps.json"  # 埋め込み済み XMP の記録 (出力フォルダ内)
+
+
+def _xmp_stamp(fp: Path, tags_hash: str) -> list:
+    """タグとファイルの状態から記録を作る (ファイルが書き換わると一致しなくなる)"""
+    st = fp.stat()
+    return [tags_hash, st.st_mtime_ns, st.st_size]
+
+
 def embed_xmp(records: list, output_dir: Path) -> int:
-    """全ファイルに XMP を埋め込む"""
+    """全ファイルに XMP を埋め込む (スレッド並列・埋め込み済みは skip)"""
     print("  Using: Python built-in XMP writer")
 
-    embedded = 0
-    total = sum(
-        1 for r in records if (output_dir / f"{r['data-id']}.{r['file_ext']}").exists()
-    )
+    stamp_path = output_dir / XMP_STAMP_NAME
+    # {ファイル名: [tags の md5, mtime_ns, size]}
+    stamps = _load_json_dict(stamp_path)
 
-    for i, rec in enumerate(records, 1):
-        fp = output_dir / f"{rec['data-id']}.{rec['file_ext']}"
-        if not fp.exists():
+    present = frozenset(os.listdir(output_dir))
+    targets = []
+    up_to_date = 0
+    for rec in records:
+        name = f"{rec['data-id']}.{rec['file_ext']}"
+        if name not in present:
+            continue
+        fp = output_dir / name
+        tags_hash = hashlib.md5(rec["data-tags"].encode("utf-8")).hexdigest()
+        if stamps.get(fp.name) == _xmp_stamp(fp, tags_hash):
+            up_to_date += 1
             continue
+        targets.append((rec, fp, tags_hash))
 
-        tags_str = rec["data-tags"]
+    if up_to_date:
+        print(f"  Already embedded: {up_to_date}")
 
-        if embed_xmp_single(fp, tags_str):
-            embedded += 1
-            if embedded <= 3 or embedded % 20 == 0:
-                print(f"  XMP [{embedded}/{total}] #{rec['data-id']}")
+    embedded = 0
+    total = len(targets)
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as ex:
+        futures = {
+            ex.submit(embed_xmp_single, fp, rec["data-tags"]): (rec, fp, tags_hash)
+            for rec, fp, tags_hash in targets
+        }
+        for fut in as_completed(futures):
+            if fut.result():
+                rec, fp, tags_hash = futures[fut]
+                stamps[fp.name] = _xmp_stamp(fp, tags_hash)
+                embedded += 1
+                if embedded <= 3 or embedded % 20 == 0:
+                    print(f"  XMP [{embedded}/{total}] #{rec['data-id']}")
+
+    if embedded:
+        _json_dump(stamps, stamp_path)
 
     return embedded
 
@@ -498,8 +804,7 @@ def main():
     # [2] JSON 保存
     print("[2/4] Saving metadata JSON ...")
     records = build_metadata(posts)
-    with open(JSON_FILE, "w", encoding="utf-8") as f:
-        json.dump(records, f, ensure_ascii=False, indent=2)
+    _json_dump(records, JSON_FILE, indent=True)
     print(f"  {len(records)} records -> {JSON_FILE.name}")
     print()
 
@@ -10,19 +10,42 @@ Danbooru Multi-Tag Search & Download (Gradio UI)
   python danbooru_search_ui.py
   → ブラウザで http://localhost:7860 を開く
 """
+import bisect
+import hashlib
 import json
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
 import sys
+import threading
 import time
+import zlib
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urlencode
 
 import requests
-import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
 import gradio as gr
 
+try:
+    import orjson
+except ImportError:  # orjson が無ければ標準の json を使う
+    orjson = None
+
 # ============================================================
 # 設定
 # ============================================================
@@ -50,14 +73,115 @@ SDXL_RESOLUTIONS = [
 
 ALLOWED_EXT = {"jpg", "jpeg", "png", "webp", "gif"}
 
+# Rating フィルタの選択肢 → API の rating 値
+RATING_CODES = {"safe": "g", "sensitive": "s", "questionable": "q", "explicit": "e"}
+
+# 縮小時の reducing_gap (大きいほど高画質・低速。None で常にフル bicubic)
+RESIZE_REDUCING_GAP = 2.0
+
 PREVIEW_PER_PAGE = 20  # ギャラリー1ページあたりの表示数 (5列×4行)
 GRID_COLS = 5
 GRID_ROWS = 4
+SEARCH_WORKERS = 6  # API ページの同時取得数
+API_RATE_LIMIT = 10  # API リクエスト数/秒 (全スレッド合計)
+PREVIEW_WORKERS = 16  # プレビュー画像の同時ダウンロード数
+DOWNLOAD_WORKERS = 8  # 原寸画像の同時ダウンロード数
+DOWNLOAD_RATE_LIMIT = 5  # 原寸画像のリクエスト数/秒 (全スレッド合計)
+POSTPROCESS_WORKERS = os.cpu_count() or 1  # リサイズ/XMP のプロセス数
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # ダウンロード時のコピー単位
+LOG_UPDATE_INTERVAL = 0.5  # ダウンロードログを画面に送る最短間隔 (秒)
+
+
+# ============================================================
+# HTTP / JSON
+# ============================================================
+def _new_session() -> requests.Session:
+    """keep-alive 接続をプールし、429/5xx はバックオフ付きで再試行する Session"""
+    session = requests.Session()
+    session.headers["User-Agent"] = "DanbooruSearchUI/1.0"
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def _api_session() -> requests.Session:
+    """API (danbooru.donmai.us) 用の共有 Session (認証付き)"""
+    session = _new_session()
+    session.auth = AUTH
+    return session
+
+
+@lru_cache(maxsize=None)
+def _cdn_session() -> requests.Session:
+    """画像 CDN 用の共有 Session (認証情報は送らない)"""
+    return _new_session()
+
+
+def _json_loads(data: bytes):
+    """JSON をパース (orjson があれば使う)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dump(obj, path: Path, indent: bool = False):
+    """JSON をファイルに書き出す (orjson があれば使う)"""
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=option))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, ensure_ascii=False, indent=2 if indent else None)
 
 
 # ============================================================
 # Danbooru API 検索 (2タグ制限回避)
 # ============================================================
+class _RateLimiter:
+    """全スレッド共通のレート制限 (1/rate 秒間隔でリクエストを発行)"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _preview_url(p: dict) -> str:
+    """プレビューURL (小さい画像)"""
+    return (
+        p.get("preview_file_url") or p.get("large_file_url") or p.get("file_url", "")
+    )
+
+
+def _annotate_post(p: dict):
+    """
+    ページ描画で毎回計算しないよう、派生値を投稿に持たせておく。
+    フィルタを通った投稿だけに対して呼ぶ
+    """
+    # プレビューのキャッシュ名は URL のハッシュで決める
+    # (URL が変われば別ファイルになり、古いキャッシュを表示しない)
+    url = _preview_url(p)
+    ext = url.rsplit(".", 1)[-1].split("?")[0] or "jpg"
+    key = hashlib.blake2b(url.encode("utf-8"), digest_size=8).hexdigest()
+    p["_preview_file"] = f"{p['id']}_{key}.{ext}"
+
+
 def search_danbooru(
     tags_input: str,
     max_results: int = 100,
@@ -89,13 +213,7 @@ def search_danbooru(
     # Python 側でフィルタする追加タグ
     extra_include = include_tags[2:]
 
-    session = requests.Session()
-    session.auth = AUTH
-    session.headers["User-Agent"] = "DanbooruSearchUI/1.0"
-
-    all_posts = []
-    seen_ids = set()
-    page = 1
+    session = _api_session()
     api_tag_str = " ".join(api_tags)
 
     status_log = f'API検索: "{api_tag_str}"\n'
@@ -108,125 +226,281 @@ def search_danbooru(
     fetch_limit = max_results * 5 if extra_include else max_results * 2
     fetch_limit = min(fetch_limit, 5000)
 
-    while len(all_posts) < fetch_limit:
-        if progress_cb:
-            progress_cb(
-                len(all_posts) / fetch_limit,
-                desc=f"API取得中... {len(all_posts)}/{fetch_limit} posts (page {page})",
-            )
+    # --- Python 側フィルタ条件 ---
+    # 安い比較 (拡張子・rating・スコア) を先に行い、
+    # 残った投稿だけタグを照合する
+    rating_code = RATING_CODES.get(rating_filter)  # "all" なら None
+    include_set = frozenset(extra_include)
+    exclude_set = frozenset(exclude_tags)
+    check_tags = bool(include_set or exclude_set)
+
+    def matches(p):
+        # 画像のみ
+        if p.get("file_ext", "").lower() not in ALLOWED_EXT:
+            return False
+
+        # Rating フィルタ
+        if rating_code is not None and p.get("rating", "") != rating_code:
+            return False
+
+        # スコアフィルタ
+        if p.get("score", 0) < min_score:
+            return False
+
+        if check_tags:
+            # タグの分割は安い比較を通った投稿だけ行う
+            post_tags = frozenset(p.get("tag_string", "").split())
+
+            # 追加タグフィルタ
+            if not include_set.issubset(post_tags):
+                return False
+
+            # 除外タグ
+            if not exclude_set.isdisjoint(post_tags):
+                return False
+
+        return True
+
+    limiter = _RateLimiter(API_RATE_LIMIT)
+    # 最終ページ (短いページ・エラー) が見つかったらそれより後は取りに行かない
+    # (ページ間で重複があると必要なページ数は事前に決まらないので上限は設けない)
+    last_page = [sys.maxsize]
+    last_lock = threading.Lock()
+
+    def fetch(page):
+        # 打ち切り済みのページはレートリミッタの順番待ちもしない
+        if page > last_page[0]:
+            return None, []
+        limiter.wait()
+        if page > last_page[0]:
+            return None, []
         params = {"tags": api_tag_str, "limit": PER_PAGE, "page": page}
         resp = session.get(f"{BASE_URL}/posts.json", params=params)
+        posts = _json_loads(resp.content) if resp.status_code == 200 else []
+        if resp.status_code != 200 or len(posts) < PER_PAGE:
+            with last_lock:
+                last_page[0] = min(last_page[0], page)
+        return resp.status_code, posts
 
-        if resp.status_code != 200:
-            status_log += f"API Error: HTTP {resp.status_code}\n"
-            break
+    posts_by_id = {}  # id -> post (重複除去しつつ取得順を保つ)
+    filtered = []
+    pages = {}  # 取得済みで未処理のページ
+    next_page = 1
+
+    def consume() -> bool:
+        """
+        届いたページをページ順に結合・フィルタする (取得と並行して進める)。
+        打ち切り条件 (エラー・空/短いページ・件数到達) に達したら True
+        """
+        nonlocal next_page, status_log
+        while next_page in pages:
+            status, posts = pages.pop(next_page)
+            next_page += 1
+            if status is None:
+                return True
+            if isinstance(status, Exception):
+                status_log += f"API Error: {status}\n"
+                return True
+            if status != 200:
+                status_log += f"API Error: HTTP {status}\n"
+                return True
+            if not posts:
+                return True
+
+            for p in posts:
+                if posts_by_id.setdefault(p["id"], p) is p:
+                    if len(filtered) < max_results and matches(p):
+                        _annotate_post(p)
+                        filtered.append(p)
+
+            if (
+                len(posts) < PER_PAGE
+                or len(filtered) >= max_results
+                or len(posts_by_id) >= fetch_limit
+            ):
+                return True
+        return False
 
-        posts = resp.json()
-        if not posts:
-            break
+    # 重複が無ければ fetch_limit に届く分だけページを投機的に並列取得し、
+    # 届いたページから順に結合する。重複で足りなければ続きのページを追加で投げる
+    # (無駄打ちはレートリミッタと last_page による打ち切りで抑える)
+    if progress_cb:
+        progress_cb(0, desc=f"API取得中... 0/{fetch_limit} posts (page 1)")
+    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as ex:
+        futures = {}  # 取得中の Future -> ページ番号
+        submitted = 0  # 投げた最後のページ
+
+        def submit_more():
+            nonlocal submitted
+            while (
+                len(futures) < SEARCH_WORKERS
+                and submitted < last_page[0]
+                and len(posts_by_id) + (submitted + 1 - next_page) * PER_PAGE
+                < fetch_limit
+            ):
+                submitted += 1
+                futures[ex.submit(fetch, submitted)] = submitted
+
+        submit_more()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for fut in done:
+                page = futures.pop(fut)
+                try:
+                    pages[page] = fut.result()
+                except Exception as e:
+                    pages[page] = (e, [])
+                    with last_lock:
+                        last_page[0] = min(last_page[0], page)
+            finished = consume()
+            if progress_cb:
+                progress_cb(
+                    min(len(posts_by_id) / fetch_limit, 1.0),
+                    desc=f"API取得中... {len(posts_by_id)}/{fetch_limit} posts"
+                    f" (page {next_page}, {len(filtered)}/{max_results} 件ヒット)",
+                )
+            if finished:
+                # 必要な件数が揃った・最終ページに達した → 残りのページは取得しない
+                with last_lock:
+                    last_page[0] = min(last_page[0], next_page - 1)
+                for f in futures:
+                    f.cancel()
+                break
+            submit_more()
+
+    status_log += f"API取得: {len(posts_by_id)} posts\n"
+    status_log += f"フィルタ後: {len(filtered)} posts\n"
 
-        for p in posts:
-            if p["id"] not in seen_ids:
-                seen_ids.add(p["id"])
-                all_posts.append(p)
+    return filtered, status_log
 
-        if len(posts) < PER_PAGE:
-            break
-        page += 1
-        time.sleep(0.3)
 
-    status_log += f"API取得: {len(all_posts)} posts\n"
+# ============================================================
+# プレビュー画像取得
+# ============================================================
+def _fetch_preview(session, url: str, local_path: Path) -> bool:
+    """プレビュー画像を 1 枚ダウンロードしてキャッシュに保存"""
+    try:
+        r = session.get(url, timeout=10)
+        if r.status_code != 200:
+            return False
+        local_path.write_bytes(r.content)
+        return True
+    except Exception:
+        return False
 
-    # --- Python 側フィルタリング ---
-    filtered = []
-    for p in all_posts:
-        post_tags = set(p.get("tag_string", "").split())
-        rating = p.get("rating", "")
-        score = p.get("score", 0)
-        ext = p.get("file_ext", "")
 
-        # 画像のみ
-        if ext.lower() not in ALLOWED_EXT:
-            continue
+_preview_files = None  # プレビューキャッシュにあるファイル名 (初回に 1 回だけ列挙)
 
-        # 追加タグフィルタ
-        if extra_include and not all(t in post_tags for t in extra_include):
-            continue
 
-        # 除外タグ
-        if exclude_tags and any(t in post_tags for t in exclude_tags):
-            continue
+def _cached_previews(preview_dir: Path) -> set:
+    """キャッシュ済みプレビューのファイル名集合 (ファイルごとの stat() を避ける)"""
+    global _preview_files
+    if _preview_files is None:
+        with os.scandir(preview_dir) as it:
+            _preview_files = {entry.name for entry in it}
+    return _preview_files
 
-        # Rating フィルタ
-        if rating_filter != "all":
-            if rating_filter == "safe" and rating != "g":
-                continue
-            elif rating_filter == "sensitive" and rating != "s":
-                continue
-            elif rating_filter == "questionable" and rating != "q":
-                continue
-            elif rating_filter == "explicit" and rating != "e":
-                continue
 
-        # スコアフィルタ
-        if score < min_score:
-            continue
+# 次ページ分の先読み用 (検索・ページ送りの応答を待たせずに裏で取得する)
+_prefetch_pool = ThreadPoolExecutor(
+    max_workers=PREVIEW_WORKERS, thread_name_prefix="preview-prefetch"
+)
+_prefetching = {}  # ファイル名 -> 先読み中の Future
 
-        filtered.append(p)
 
-        if len(filtered) >= max_results:
-            break
+def _prefetch_done(name: str, fut) -> None:
+    # キャッシュ集合に追加してから外す (get_preview_data 側は
+    # _prefetching → キャッシュ集合 の順に見るので取りこぼさない)
+    if not fut.cancelled() and fut.result():
+        _preview_files.add(name)
+    _prefetching.pop(name, None)
 
-    status_log += f"フィルタ後: {len(filtered)} posts\n"
 
-    return filtered, status_log
+def prefetch_previews(posts: list) -> None:
+    """プレビュー画像をバックグラウンドでキャッシュに取り込む (完了は待たない)"""
+    import tempfile
+
+    preview_dir = Path(tempfile.gettempdir()) / "danbooru_previews"
+    preview_dir.mkdir(exist_ok=True)
+    cached = _cached_previews(preview_dir)
+
+    session = _cdn_session()
+    for p in posts:
+        preview_url = _preview_url(p)
+        name = p["_preview_file"]
+        if not preview_url or name in cached or name in _prefetching:
+            continue
+        fut = _prefetch_pool.submit(
+            _fetch_preview, session, preview_url, preview_dir / name
+        )
+        _prefetching[name] = fut
+        fut.add_done_callback(lambda f, name=name: _prefetch_done(name, f))
 
 
-# ============================================================
-# プレビュー画像取得
-# ============================================================
 def get_preview_data(posts: list, progress_cb=None) -> list:
     """各投稿のプレビュー画像をダウンロードしてギャラリー用リストを返す"""
     import tempfile
 
     preview_dir = Path(tempfile.gettempdir()) / "danbooru_previews"
     preview_dir.mkdir(exist_ok=True)
+    cached = _cached_previews(preview_dir)
 
-    session = requests.Session()
-    session.headers["User-Agent"] = "DanbooruSearchUI/1.0"
-
-    total = len(posts)
-    gallery_items = []
-    for idx, p in enumerate(posts):
-        if progress_cb and total > 0:
-            progress_cb(
-                idx / total,
-                desc=f"プレビュー取得中... {idx}/{total}",
-            )
-        pid = p["id"]
-        # プレビューURL (小さい画像)
-        preview_url = (
-            p.get("preview_file_url")
-            or p.get("large_file_url")
-            or p.get("file_url", "")
-        )
+    # (投稿, ローカルパス) の一覧と、未キャッシュ分のダウンロード対象
+    entries = []
+    to_fetch = []
+    in_flight = []  # 先読み中のものは取り直さず完了を待つ
+    for p in posts:
+        preview_url = _preview_url(p)
         if not preview_url:
             continue
 
         # ローカルにキャッシュ
-        ext = preview_url.rsplit(".", 1)[-1].split("?")[0] or "jpg"
-        local_path = preview_dir / f"{pid}.{ext}"
-        if not local_path.exists():
-            try:
-                r = session.get(preview_url, timeout=10)
-                if r.status_code == 200:
-                    local_path.write_bytes(r.content)
+        local_path = preview_dir / p["_preview_file"]
+        entries.append((p, local_path))
+        fut = _prefetching.get(local_path.name)
+        if fut is not None:
+            in_flight.append((fut, local_path))
+        elif local_path.name not in cached:
+            to_fetch.append((preview_url, local_path))
+
+    # 未キャッシュ分をスレッドプールで並列ダウンロード
+    failed = set()
+    if to_fetch:
+        session = _cdn_session()
+        total = len(to_fetch)
+        with ThreadPoolExecutor(max_workers=PREVIEW_WORKERS) as ex:
+            futures = {
+                ex.submit(_fetch_preview, session, url, local_path): local_path
+                for url, local_path in to_fetch
+            }
+            for done, fut in enumerate(as_completed(futures), 1):
+                if fut.result():
+                    cached.add(futures[fut].name)
                 else:
-                    continue
-            except:
-                continue
+                    failed.add(futures[fut])
+                if progress_cb:
+                    progress_cb(
+                        done / total,
+                        desc=f"プレビュー取得中... {done}/{total}",
+                    )
+    for fut, local_path in in_flight:
+        try:
+            ok = fut.result()
+        except Exception:
+            ok = False
+        if ok:
+            cached.add(local_path.name)
+        else:
+            failed.add(local_path)
+
+    # 元の順序でギャラリー用リストを組み立てる
+    gallery_items = []
+    for p, local_path in entries:
+        if local_path in failed:
+            continue
 
         # キャプション
+        pid = p["id"]
         tags_short = p.get("tag_string", "")[:100]
         rating = p.get("rating", "?")
         score = p.get("score", 0)
@@ -240,40 +514,79 @@ def get_preview_data(posts: list, progress_cb=None) -> list:
 # ============================================================
 # SDXL リサイズ
 # ============================================================
+# (アスペクト比, 元の並び順, 解像度) をアスペクト比でソートして事前計算
+_SDXL_SORTED = sorted(
+    (rw / rh, i, (rw, rh)) for i, (rw, rh) in enumerate(SDXL_RESOLUTIONS)
+)
+_SDXL_KEYS = [a[0] for a in _SDXL_SORTED]
+
+
+@lru_cache(maxsize=2048)
 def find_closest_sdxl_resolution(w: int, h: int) -> tuple:
     aspect = w / h
-    best = min(SDXL_RESOLUTIONS, key=lambda r: abs((r[0] / r[1]) - aspect))
-    return best
+    # 二分探索で挟まれる 2 候補だけ比較 (同距離なら SDXL_RESOLUTIONS の先頭側)
+    i = bisect.bisect_left(_SDXL_KEYS, aspect)
+    candidates = _SDXL_SORTED[max(0, i - 1) : i + 1]
+    return min(candidates, key=lambda a: (abs(a[0] - aspect), a[1]))[2]
+
+
+# ワーカーごとに SDXL サイズ別のキャンバスを使い回す (解像度は 9 種類しかない)
+_canvas_cache = threading.local()
+
+
+def _get_canvas(size: tuple) -> Image.Image:
+    """呼び出しスレッド専用のキャンバスを返す (中身は呼び出し側で全面上書きする)"""
+    canvases = getattr(_canvas_cache, "canvases", None)
+    if canvases is None:
+        canvases = _canvas_cache.canvases = {}
+    canvas = canvases.get(size)
+    if canvas is None:
+        canvas = canvases[size] = Image.new("RGB", size)
+    return canvas
 
 
 def resize_to_sdxl(filepath: Path) -> bool:
     try:
-        img = Image.open(filepath).convert("RGB")
-        orig_w, orig_h = img.size
-        target_w, target_h = find_closest_sdxl_resolution(orig_w, orig_h)
+        # Image.open はヘッダのみ読む (ピクセルのデコードは必要になるまで遅延)
+        with Image.open(filepath) as src:
+            orig_w, orig_h = src.size
+            target_w, target_h = find_closest_sdxl_resolution(orig_w, orig_h)
 
-        if orig_w == target_w and orig_h == target_h:
-            return True
+            if orig_w == target_w and orig_h == target_h:
+                return True
 
-        # 平均色
-        arr = np.array(img)
-        avg_color = tuple(arr.mean(axis=(0, 1)).astype(int))
+            scale = min(target_w / orig_w, target_h / orig_h)
+            new_w = round(orig_w * scale)
+            new_h = round(orig_h * scale)
+
+            # JPEG は DCT 段階で 1/2・1/4・1/8 に縮小しながらデコードする
+            # (出力サイズ以上は保つので、最終的な bicubic の入力が小さくなるだけ)
+            if scale < 0.5 and src.format == "JPEG":
+                src.draft("RGB", (new_w, new_h))
+            img = src.convert("RGB")
 
         # bicubic リサイズ (fit inside)
-        scale = min(target_w / orig_w, target_h / orig_h)
-        new_w = round(orig_w * scale)
-        new_h = round(orig_h * scale)
-        img_resized = img.resize((new_w, new_h), Image.BICUBIC)
+        # 縮小時は先に整数倍の BOX 縮小を挟んで bicubic の計算量を減らす
+        reducing_gap = RESIZE_REDUCING_GAP if scale < 1.0 else None
+        img_resized = img.resize(
+            (new_w, new_h), Image.BICUBIC, reducing_gap=reducing_gap
+        )
 
-        # 平均色パディング
-        canvas = Image.new("RGB", (target_w, target_h), avg_color)
+        # 平均色 (元画像ではなく縮小後の画像で計算。色はほぼ同じで走査量が少ない)
+        # BOX フィルタで 1x1 に縮小すると全画素の平均になる
+        avg_color = img_resized.resize((1, 1), Image.BOX).getpixel((0, 0))
+
+        # 平均色パディング (確保済みキャンバスを平均色で塗りつぶしてから貼る)
+        canvas = _get_canvas((target_w, target_h))
+        canvas.paste(avg_color, (0, 0, target_w, target_h))
         paste_x = (target_w - new_w) // 2
         paste_y = (target_h - new_h) // 2
         canvas.paste(img_resized, (paste_x, paste_y))
 
         ext = filepath.suffix.lower()
         if ext in (".jpg", ".jpeg"):
-            canvas.save(filepath, "JPEG", quality=95)
+            # 学習用途なので色差を間引かず (4:4:4)、ハフマン表も最適化する
+            canvas.save(filepath, "JPEG", quality=95, subsampling=0, optimize=True)
         elif ext == ".png":
             canvas.save(filepath, "PNG")
         elif ext == ".webp":
@@ -289,80 +602,160 @@ def resize_to_sdxl(filepath: Path) -> bool:
 # ============================================================
 # XMP 埋め込み (Python 内蔵)
 # ============================================================
-def _build_xmp_packet(tags_str: str) -> str:
-    """XMP XML パケットを構築 (dc:description + dc:title のみ)"""
-
-    def esc(s):
-        return (
-            s.replace("&", "&amp;")
-            .replace("<", "&lt;")
-            .replace(">", "&gt;")
-            .replace('"', "&quot;")
-        )
+# XML エスケープ用の変換テーブル (1 パスで置換)
+_XMP_ESC_TABLE = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}
+)
 
-    xmp = f"""<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>
+_XMP_TEMPLATE = """<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>
 <x:xmpmeta xmlns:x="adobe:ns:meta/">
   <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
     <rdf:Description
       xmlns:dc="http://purl.org/dc/elements/1.1/">
       <dc:description>
         <rdf:Alt>
-          <rdf:li xml:lang="x-default">{esc(tags_str)}</rdf:li>
+          <rdf:li xml:lang="x-default">{tags}</rdf:li>
         </rdf:Alt>
       </dc:description>
       <dc:title>
         <rdf:Alt>
-          <rdf:li xml:lang="x-default">{esc(tags_str)}</rdf:li>
+          <rdf:li xml:lang="x-default">{tags}</rdf:li>
         </rdf:Alt>
       </dc:title>
     </rdf:Description>
   </rdf:RDF>
 </x:xmpmeta>
 <?xpacket end="w"?>"""
-    return xmp
+
+
+def _build_xmp_packet(tags_str: str) -> str:
+    """XMP XML パケットを構築 (dc:description + dc:title のみ)"""
+    return _XMP_TEMPLATE.format(tags=tags_str.translate(_XMP_ESC_TABLE))
+
+
+@contextmanager
+def _rewrite_file(filepath: Path):
+    """一時ファイルに書き出し、成功したら元ファイルと置き換える"""
+    tmp_path = filepath.with_name(filepath.name + ".tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+_XMP_APP1_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
 
 
 def _embed_xmp_to_jpeg(filepath: Path, xmp_packet: str) -> bool:
     """JPEG に XMP パケットを埋め込む (APP1 マーカー)"""
     xmp_bytes = xmp_packet.encode("utf-8")
-    xmp_header = b"http://ns.adobe.com/xap/1.0/\x00"
-    app1_data = xmp_header + xmp_bytes
+    app1_data = _XMP_APP1_HEADER + xmp_bytes
     app1_length = len(app1_data) + 2
+    app1_marker = b"\xff\xe1" + app1_length.to_bytes(2, "big") + app1_data
 
     with open(filepath, "rb") as f:
-        data = f.read()
-
-    if data[:2] != b"\xff\xd8":
-        return False
-
-    pos = 2
-    new_data = b"\xff\xd8"
-    while pos < len(data):
-        if data[pos : pos + 2] == b"\xff\xe1":
-            seg_len = int.from_bytes(data[pos + 2 : pos + 4], "big")
-            seg_body = data[pos + 4 : pos + 2 + seg_len]
-            if seg_body.startswith(b"http://ns.adobe.com/xap/1.0/\x00"):
+        if f.read(2) != b"\xff\xd8":
+            return False
+
+    # 元ファイルは mmap で参照し、画像データ部分をコピーせずに書き出す。
+    # Windows では開いたままのファイルを置き換えられないので、
+    # mmap・元ファイルを閉じてから _rewrite_file が置き換える
+    with _rewrite_file(filepath) as dst:
+        with open(filepath, "rb") as src, mmap.mmap(
+            src.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            pos = 2
+            while mm[pos : pos + 2] == b"\xff\xe1":
+                seg_len = int.from_bytes(mm[pos + 2 : pos + 4], "big")
+                if not mm[pos + 4 : pos + 2 + seg_len].startswith(_XMP_APP1_HEADER):
+                    break
                 pos += 2 + seg_len
-                continue
-        break
-
-    rest = data[pos:]
-    app1_marker = b"\xff\xe1" + app1_length.to_bytes(2, "big") + app1_data
-    result = b"\xff\xd8" + app1_marker + rest
 
-    with open(filepath, "wb") as f:
-        f.write(result)
+            with memoryview(mm) as view:
+                dst.write(b"\xff\xd8")
+                dst.write(app1_marker)
+                dst.write(view[pos:])
     return True
 
 
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_XMP_KEYWORD = b"XML:com.adobe.xmp"
+# 旧実装 (PngInfo.add_text) は Latin-1 に収まると tEXt で書いていたので、
+# 既存 XMP はテキスト系チャンク 3 種すべてから探す
+_PNG_TEXT_CHUNKS = (b"tEXt", b"zTXt", b"iTXt")
+
+
 def _embed_xmp_to_png(filepath: Path, xmp_packet: str) -> bool:
-    """PNG に XMP を iTXt チャンクとして埋め込む"""
-    from PIL.PngImagePlugin import PngInfo
+    """PNG に XMP を iTXt チャンクとして埋め込む (IDAT は再エンコードせずコピー)"""
+    # iTXt: keyword\0 + 圧縮フラグ 0 + 圧縮方式 0 + 言語タグ\0 + 翻訳キーワード\0 + テキスト
+    itxt_data = _PNG_XMP_KEYWORD + b"\x00\x00\x00\x00\x00" + xmp_packet.encode("utf-8")
+    itxt_crc = zlib.crc32(b"iTXt" + itxt_data)
+    itxt_chunk = (
+        len(itxt_data).to_bytes(4, "big")
+        + b"iTXt"
+        + itxt_data
+        + itxt_crc.to_bytes(4, "big")
+    )
 
-    img = Image.open(filepath)
-    meta = PngInfo()
-    meta.add_text("XML:com.adobe.xmp", xmp_packet, zip=False)
-    img.save(filepath, "PNG", pnginfo=meta)
+    with open(filepath, "rb") as f:
+        if f.read(8) != _PNG_SIGNATURE:
+            return False  # Not PNG
+
+    # チャンク単位でコピー。既存の XMP (tEXt/zTXt/iTXt) は除去し、
+    # IHDR の直後に新しい iTXt を挿入
+    with _rewrite_file(filepath) as dst, open(filepath, "rb") as src:
+        dst.write(src.read(8))
+        while True:
+            head = src.read(8)
+            if len(head) < 8:
+                break
+            chunk_len = int.from_bytes(head[:4], "big")
+            chunk_type = head[4:8]
+            body = src.read(chunk_len + 4)  # data + CRC
+            if chunk_type in _PNG_TEXT_CHUNKS and body.startswith(
+                _PNG_XMP_KEYWORD + b"\x00"
+            ):
+                continue
+            dst.write(head)
+            dst.write(body)
+            if chunk_type == b"IHDR":
+                dst.write(itxt_chunk)
+    return True
+
+
+def _append_xmp_to_webp(filepath: Path, xmp_bytes: bytes) -> bool:
+    """
+    XMP チャンクを末尾に追記し、RIFF サイズだけ書き換える (画像データは読まない)。
+    既存データは一切書き換えないので、途中で落ちても末尾に余分なバイトが
+    残るだけで画像は壊れない (RIFF サイズ外のデータはデコーダが無視する)。
+    既存の XMP がある・末尾にゴミがある等の場合は False を返す。
+    """
+    with open(filepath, "r+b") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        f.seek(12)
+        pos = 12
+        while pos + 8 <= file_size:
+            head = f.read(8)
+            if head[:4] == b"XMP ":
+                return False  # 置き換えは _rewrite_file 経由で行う
+            chunk_size = int.from_bytes(head[4:8], "little")
+            pos += 8 + chunk_size + (chunk_size % 2)
+            f.seek(pos)
+        if pos != file_size:
+            return False
+
+        size = len(xmp_bytes)
+        chunk = b"XMP " + size.to_bytes(4, "little") + xmp_bytes
+        if size % 2 == 1:
+            chunk += b"\x00"
+        f.seek(file_size)
+        f.write(chunk)
+        f.flush()
+        f.seek(4)
+        f.write((file_size + len(chunk) - 8).to_bytes(4, "little"))
     return True
 
 
@@ -371,13 +764,20 @@ def _embed_xmp_to_webp(filepath: Path, xmp_packet: str) -> bool:
     xmp_bytes = xmp_packet.encode("utf-8")
 
     with open(filepath, "rb") as f:
-        data = f.read()
+        header = f.read(12)
 
-    if data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+    if header[:4] != b"RIFF" or header[8:12] != b"WEBP":
         xmp_path = filepath.with_suffix(".xmp")
         xmp_path.write_text(xmp_packet, encoding="utf-8")
         return True
 
+    # 初回の埋め込みはチャンクヘッダだけ辿って末尾に追記すれば済む
+    if _append_xmp_to_webp(filepath, xmp_bytes):
+        return True
+
+    with open(filepath, "rb") as f:
+        data = f.read()
+
     pos = 12
     chunks = []
     while pos < len(data):
@@ -393,26 +793,54 @@ def _embed_xmp_to_webp(filepath: Path, xmp_packet: str) -> bool:
 
     chunks.append((b"XMP ", xmp_bytes))
 
-    body = b"WEBP"
+    # bytes の += 連結は毎回コピーが走るので、部品をリストに溜めて一括で書く
+    parts = [b"WEBP"]
     for chunk_id, chunk_data in chunks:
         size = len(chunk_data)
-        body += chunk_id + size.to_bytes(4, "little") + chunk_data
+        parts.append(chunk_id)
+        parts.append(size.to_bytes(4, "little"))
+        parts.append(chunk_data)
         if size % 2 == 1:
-            body += b"\x00"
-
-    result = b"RIFF" + len(body).to_bytes(4, "little") + body
+            parts.append(b"\x00")
+    body_size = sum(len(part) for part in parts)
 
-    with open(filepath, "wb") as f:
-        f.write(result)
+    # 一時ファイルに書いてから置き換える (途中で落ちても元画像は壊れない)
+    with _rewrite_file(filepath) as f:
+        f.write(b"RIFF" + body_size.to_bytes(4, "little"))
+        f.writelines(parts)
     return True
 
 
+_XMP_SCAN_SIZE = 64 * 1024  # 既存 XMP を探す範囲 (先頭・末尾それぞれ)
+
+
+def _has_xmp_packet(filepath: Path, xmp_bytes: bytes) -> bool:
+    """
+    同じ XMP パケットが既に埋め込まれているか (先頭と末尾だけ読む)。
+    JPEG/PNG は先頭付近、WebP は末尾に XMP があるため両端を見れば足りる。
+    """
+    with open(filepath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(_XMP_SCAN_SIZE)
+        if xmp_bytes in head:
+            return True
+        if size <= _XMP_SCAN_SIZE:
+            return False
+        f.seek(-min(_XMP_SCAN_SIZE, size - _XMP_SCAN_SIZE), os.SEEK_END)
+        return xmp_bytes in f.read()
+
+
 def embed_xmp(filepath: Path, tags_str: str) -> bool:
     """1ファイルに XMP を埋め込む (Python 内蔵)"""
     xmp_packet = _build_xmp_packet(tags_str)
 
     ext = filepath.suffix.lower()
     try:
+        # 同じタグで埋め込み済みならファイルを書き換えない
+        if ext in (".jpg", ".jpeg", ".png", ".webp") and _has_xmp_packet(
+            filepath, xmp_packet.encode("utf-8")
+        ):
+            return True
         if ext in (".jpg", ".jpeg"):
             return _embed_xmp_to_jpeg(filepath, xmp_packet)
         elif ext == ".png":
@@ -428,99 +856,220 @@ def embed_xmp(filepath: Path, tags_str: str) -> bool:
 # ============================================================
 # ダウンロード＆処理
 # ============================================================
+def _preallocate(f, r):
+    """サイズが分かっていれば先に領域を確保して断片化を抑える (POSIX のみ)"""
+    length = r.headers.get("Content-Length")
+    # 圧縮転送だと展開後のサイズと一致しないので確保しない
+    if not length or r.headers.get("Content-Encoding"):
+        return
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, int(length))
+    except (OSError, ValueError):
+        pass
+
+
+def _download_post(
+    session, limiter: _RateLimiter, p: dict, out_dir: Path, present: frozenset
+) -> tuple:
+    """
+    1投稿分をダウンロード (present に含まれていれば skip)。
+    (pid, 保存先 or None, downloaded, エラー文字列 or None) を返す
+    """
+    pid = p["id"]
+    ext = p.get("file_ext", "jpg")
+    file_url = p.get("file_url") or p.get("large_file_url") or ""
+
+    if not file_url:
+        return pid, None, False, None
+
+    fp = out_dir / f"{pid}.{ext}"
+    if fp.name in present:
+        return pid, fp, False, None
+
+    # 途中で失敗した時に壊れたファイル (事前確保でサイズだけは正しい) が
+    # 残って次回 skip されないよう、.part に書いてから置き換える
+    part_path = fp.with_name(fp.name + ".part")
+    try:
+        limiter.wait()
+        with session.get(file_url, stream=True, timeout=60) as r:
+            if r.status_code != 200:
+                return pid, None, False, f"HTTP {r.status_code}"
+            r.raw.decode_content = True
+            with open(part_path, "wb") as f:
+                _preallocate(f, r)
+                # 8 KB 単位の Python ループではなく大きめのバッファで一括コピー
+                shutil.copyfileobj(r.raw, f, DOWNLOAD_CHUNK_SIZE)
+                f.truncate()  # 確保したサイズより短かった場合に末尾を切り詰める
+        os.replace(part_path, fp)
+    except Exception as e:
+        part_path.unlink(missing_ok=True)
+        return pid, None, False, f"Error {e}"
+    return pid, fp, True, None
+
+
+def _postprocess(fp: Path, tags_str: str, do_resize: bool, do_xmp: bool) -> tuple:
+    """
+    SDXL リサイズ → XMP 埋め込み (プロセスプールで実行)。
+    (resized, xmp) を返す
+    """
+    resized = bool(do_resize and resize_to_sdxl(fp))
+    xmp = bool(do_xmp and embed_xmp(fp, tags_str))
+    return resized, xmp
+
+
+def _make_metadata(p: dict) -> dict:
+    """投稿 1 件分のメタデータ (JSON 保存用)"""
+    get = p.get
+    return {
+        "data-id": p["id"],
+        "data-tags": get("tag_string", "").replace(" ", ", "),
+        "data-rating": get("rating", ""),
+        "data-score": get("score", 0),
+        "data-uploader-id": get("uploader_id", 0),
+        "file_url": get("file_url", ""),
+        "file_ext": get("file_ext", "jpg"),
+        "source": get("source", ""),
+        "tag_string_artist": get("tag_string_artist", "").replace(" ", ", "),
+        "tag_string_character": get("tag_string_character", "").replace(" ", ", "),
+        "tag_string_copyright": get("tag_string_copyright", "").replace(" ", ", "),
+    }
+
+
+_postprocess_pool = None  # リサイズ/XMP 用のプロセスプール (初回に起動して使い回す)
+_postprocess_pool_lock = threading.Lock()
+
+
+def _get_postprocess_pool() -> ProcessPoolExecutor:
+    """
+    リサイズ/XMP 用のプロセスプールを返す。
+    マルチスレッドで動いている Gradio サーバーを fork するとロック状態ごと
+    複製されてデッドロックし得るので spawn で起動し、クリックごとに
+    作り直さず (gradio の再 import を避けて) 使い回す
+    """
+    global _postprocess_pool
+    with _postprocess_pool_lock:
+        # ワーカーが異常終了して壊れたプールは捨てて作り直す
+        if _postprocess_pool is not None and _postprocess_pool._broken:
+            _postprocess_pool.shutdown(wait=False, cancel_futures=True)
+            _postprocess_pool = None
+        if _postprocess_pool is None:
+            _postprocess_pool = ProcessPoolExecutor(
+                max_workers=POSTPROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _postprocess_pool
+
+
+def _discard_postprocess_pool(pool: ProcessPoolExecutor) -> None:
+    """壊れたプールを破棄する (次回の _get_postprocess_pool で作り直される)"""
+    global _postprocess_pool
+    with _postprocess_pool_lock:
+        if _postprocess_pool is pool:
+            _postprocess_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
 def download_selected(
-    posts_json: str,
+    posts: list,
     do_resize: bool,
     do_xmp: bool,
     output_folder: str,
     progress=gr.Progress(),
-) -> str:
-    """選択された投稿の画像をダウンロード・リサイズ・XMP埋め込み"""
-    if not posts_json:
-        return "データがありません。まず検索してください。"
-
-    posts = json.loads(posts_json)
+):
+    """
+    選択された投稿の画像をダウンロード・リサイズ・XMP埋め込み。
+    途中経過のログを随時 yield する (最後の yield が最終ログ)
+    """
     if not posts:
-        return "投稿がありません。"
+        yield "投稿がありません。"
+        return
 
     out_dir = Path(output_folder) if output_folder else DEFAULT_OUTPUT_DIR
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    session = requests.Session()
-    session.headers["User-Agent"] = "DanbooruSearchUI/1.0"
+    session = _cdn_session()
+    limiter = _RateLimiter(DOWNLOAD_RATE_LIMIT)
 
     log = f"出力先: {out_dir}\n"
     downloaded = 0
     resized = 0
     xmp_count = 0
-
-    for i, p in enumerate(progress.tqdm(posts, desc="Downloading")):
-        pid = p["id"]
-        ext = p.get("file_ext", "jpg")
-        file_url = p.get("file_url") or p.get("large_file_url") or ""
-        tags_str = p.get("tag_string", "").replace(" ", ", ")
-
-        if not file_url:
-            continue
-
-        fp = out_dir / f"{pid}.{ext}"
-
-        # ダウンロード
-        if not fp.exists():
+    yield log
+    last_yield = time.monotonic()
+
+    # 1) ダウンロード (I/O 待ちなのでスレッド並列)
+    # ファイルごとの stat() を避けるため、出力先を 1 回だけ列挙
+    present = frozenset(os.listdir(out_dir))
+    tags_by_fp = {}
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        futures = {
+            ex.submit(_download_post, session, limiter, p, out_dir, present): p
+            for p in posts
+        }
+        for done, fut in enumerate(
+            progress.tqdm(
+                as_completed(futures), total=len(futures), desc="Downloading"
+            ),
+            1,
+        ):
+            pid, fp, dl_ok, err = fut.result()
+            if err:
+                log += f"#{pid}: {err}\n"
+            else:
+                downloaded += dl_ok
+                if fp is not None:
+                    tags = futures[fut].get("tag_string", "")
+                    tags_by_fp[fp] = tags.replace(" ", ", ")
+            # エラーは即時、進捗は間引いて画面に反映
+            if err or time.monotonic() - last_yield >= LOG_UPDATE_INTERVAL:
+                yield log + f"ダウンロード中... {done}/{len(futures)}\n"
+                last_yield = time.monotonic()
+
+    # 2) リサイズ + XMP (CPU 処理なのでプロセス並列で GIL を回避)
+    # ワーカーが落ちて (巨大画像で OOM など) プールが壊れた場合は、
+    # プールを作り直して未処理分を 1 回だけ再投入し、それでも残れば報告する
+    pending = dict(tags_by_fp) if do_resize or do_xmp else {}
+    for _ in range(2):
+        if not pending:
+            break
+        ex = _get_postprocess_pool()
+        futures = {
+            ex.submit(_postprocess, fp, tags_str, do_resize, do_xmp): fp
+            for fp, tags_str in pending.items()
+        }
+        broken = False
+        for done, fut in enumerate(
+            progress.tqdm(
+                as_completed(futures), total=len(futures), desc="Processing"
+            ),
+            1,
+        ):
             try:
-                r = session.get(file_url, stream=True, timeout=60)
-                if r.status_code == 200:
-                    with open(fp, "wb") as f:
-                        for chunk in r.iter_content(8192):
-                            f.write(chunk)
-                    downloaded += 1
-                else:
-                    log += f"#{pid}: HTTP {r.status_code}\n"
-                    continue
-            except Exception as e:
-                log += f"#{pid}: Error {e}\n"
+                resize_ok, xmp_ok = fut.result()
+            except BrokenProcessPool:
+                broken = True
                 continue
-            time.sleep(0.2)
-
-        # SDXL リサイズ
-        if do_resize and fp.exists():
-            if resize_to_sdxl(fp):
-                resized += 1
-
-        # XMP 埋め込み
-        if do_xmp and fp.exists():
-            if embed_xmp(fp, tags_str):
-                xmp_count += 1
+            del pending[futures[fut]]
+            resized += resize_ok
+            xmp_count += xmp_ok
+            if time.monotonic() - last_yield >= LOG_UPDATE_INTERVAL:
+                yield log + f"リサイズ・XMP 処理中... {done}/{len(futures)}\n"
+                last_yield = time.monotonic()
+        if broken:
+            _discard_postprocess_pool(ex)
+            log += "⚠️ リサイズ/XMP のワーカープロセスが異常終了しました\n"
+            yield log
+    for fp in pending:
+        log += f"{fp.name}: リサイズ/XMP 未処理 (ワーカー異常終了)\n"
 
     # JSON メタデータ保存
-    metadata = []
-    for p in posts:
-        ext = p.get("file_ext", "jpg")
-        if ext.lower() not in ALLOWED_EXT:
-            continue
-        metadata.append(
-            {
-                "data-id": p["id"],
-                "data-tags": p.get("tag_string", "").replace(" ", ", "),
-                "data-rating": p.get("rating", ""),
-                "data-score": p.get("score", 0),
-                "data-uploader-id": p.get("uploader_id", 0),
-                "file_url": p.get("file_url", ""),
-                "file_ext": ext,
-                "source": p.get("source", ""),
-                "tag_string_artist": p.get("tag_string_artist", "").replace(" ", ", "),
-                "tag_string_character": p.get("tag_string_character", "").replace(
-                    " ", ", "
-                ),
-                "tag_string_copyright": p.get("tag_string_copyright", "").replace(
-                    " ", ", "
-                ),
-            }
-        )
+    # (posts は search_danbooru で画像の拡張子に絞り込み済みなので再チェックしない)
+    metadata = [_make_metadata(p) for p in posts]
 
     json_path = out_dir / "_search_metadata.json"
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, ensure_ascii=False, indent=2)
+    _json_dump(metadata, json_path, indent=True)
 
     log += f"\nDone!\n"
     log += f"  Downloaded: {downloaded}\n"
@@ -528,13 +1077,24 @@ def download_selected(
     log += f"  XMP:        {xmp_count}\n"
     log += f"  JSON:       {json_path.name}\n"
     log += f"  Folder:     {out_dir}\n"
-    return log
+    yield log
 
 
 # ============================================================
 # Gradio による検索・フィルタ状態の保持
 # ============================================================
-_current_posts = []
+@lru_cache(maxsize=256)
+def _count_include_tags(text: str) -> int:
+    """除外タグ (-tag) 以外のタグ数 (入力中は同じ文字列が繰り返し来るのでキャッシュ)"""
+    # リストを作らずに数える (split() は改行・連続空白も区切りとして扱う)
+    return sum(not t.startswith("-") for t in text.split())
+
+
+def _format_selected_info(n_selected: int, total: int) -> str:
+    """選択件数の表示文字列"""
+    if n_selected:
+        return f"**選択: {n_selected} / {total} 件** — ダウンロード可能"
+    return f"選択: 0 / {total} 件"
 
 
 def _build_page_data(posts, page, selected_indices=None):
@@ -542,6 +1102,8 @@ def _build_page_data(posts, page, selected_indices=None):
     import tempfile
 
     preview_dir = Path(tempfile.gettempdir()) / "danbooru_previews"
+    preview_dir.mkdir(exist_ok=True)
+    cached = _cached_previews(preview_dir)
 
     if selected_indices is None:
         selected_indices = set()
@@ -555,11 +1117,8 @@ def _build_page_data(posts, page, selected_indices=None):
         pid = p["id"]
         rating = p.get("rating", "?")
         score = p.get("score", 0)
-        ext = (p.get("preview_file_url") or "").rsplit(".", 1)[-1].split("?")[
-            0
-        ] or "jpg"
-        local_path = preview_dir / f"{pid}.{ext}"
-        img_path = str(local_path) if local_path.exists() else None
+        name = p["_preview_file"]
+        img_path = str(preview_dir / name) if name in cached else None
         label = f"#{pid} r:{rating} s:{score}"
         checked = (start + i) in selected_indices
         results.append((img_path, label, checked))
@@ -575,21 +1134,18 @@ def do_search(
     tags: str, max_results: int, rating: str, min_score: int, progress=gr.Progress()
 ):
     """検索を実行してカードグリッドとステータスを返す"""
-    global _current_posts
-
     posts, status = search_danbooru(
         tags, max_results, rating, min_score, progress_cb=progress
     )
-    _current_posts = posts
-    posts_json = json.dumps(posts)
 
-    # 最初のページのプレビュー取得
+    # 最初のページのプレビュー取得 (2 ページ目は裏で先読み)
     page_posts = posts[:PREVIEW_PER_PAGE]
     get_preview_data(page_posts, progress_cb=progress)
+    prefetch_previews(posts[PREVIEW_PER_PAGE : 2 * PREVIEW_PER_PAGE])
 
     total_pages = max(1, (len(posts) + PREVIEW_PER_PAGE - 1) // PREVIEW_PER_PAGE)
     pg_info = f"ページ 1 / {total_pages}（全 {len(posts)} 件）"
-    sel_info = f"選択: 0 / {len(posts)} 件"
+    sel_info = _format_selected_info(0, len(posts))
 
     page_data = _build_page_data(posts, 0)
 
@@ -601,35 +1157,34 @@ def do_search(
             gr.update(value=checked, label=label, visible=img_path is not None)
         )
 
-    return [status, posts_json, "[]", sel_info, 0, pg_info] + outputs
+    return [status, posts, set(), sel_info, 0, pg_info] + outputs
 
 
 def do_page_change(
-    posts_json: str,
-    selected_json: str,
+    posts: list,
+    selected_indices: set,
     current_page: int,
     direction: int,
     progress=gr.Progress(),
 ):
     """ページ切り替え"""
-    if not posts_json:
+    if not posts:
         outputs = []
         for _ in range(PREVIEW_PER_PAGE):
             outputs.append(gr.update(value=None, visible=False))
             outputs.append(gr.update(value=False, visible=False))
         return [0, "データなし"] + outputs
 
-    posts = json.loads(posts_json)
-    selected_indices = set(json.loads(selected_json)) if selected_json else set()
     total_pages = max(1, (len(posts) + PREVIEW_PER_PAGE - 1) // PREVIEW_PER_PAGE)
 
     new_page = current_page + direction
     new_page = max(0, min(new_page, total_pages - 1))
 
-    # プレビュー取得 (未キャッシュのみ)
+    # プレビュー取得 (未キャッシュのみ)。次のページは裏で先読み
     start = new_page * PREVIEW_PER_PAGE
     end = min(start + PREVIEW_PER_PAGE, len(posts))
     get_preview_data(posts[start:end], progress_cb=progress)
+    prefetch_previews(posts[end : end + PREVIEW_PER_PAGE])
 
     pg_info = f"ページ {new_page + 1} / {total_pages}（全 {len(posts)} 件）"
     page_data = _build_page_data(posts, new_page, selected_indices)
@@ -645,29 +1200,27 @@ def do_page_change(
 
 
 def do_download(
-    posts_json: str,
-    selected_json: str,
+    all_posts: list,
+    selected_indices: set,
     do_resize: bool,
     do_xmp: bool,
     output_folder: str,
 ):
-    """選択された投稿のみダウンロード"""
-    if not posts_json:
-        return "データがありません。まず検索してください。"
-
-    all_posts = json.loads(posts_json)
-    selected_indices = set(json.loads(selected_json)) if selected_json else set()
+    """選択された投稿のみダウンロード (ログは途中経過ごとに画面へ流す)"""
+    if not all_posts:
+        yield "データがありません。まず検索してください。"
+        return
 
     if not selected_indices:
-        return "⚠️ ダウンロードする画像を選択してください。\nギャラリーの画像をクリックして選択/解除できます。"
+        yield "⚠️ ダウンロードする画像を選択してください。\nギャラリーの画像をクリックして選択/解除できます。"
+        return
 
     # 選択されたインデックスの投稿だけ抽出
     selected_posts = [
         all_posts[i] for i in sorted(selected_indices) if i < len(all_posts)
     ]
-    selected_posts_json = json.dumps(selected_posts)
 
-    return download_selected(selected_posts_json, do_resize, do_xmp, output_folder)
+    yield from download_selected(selected_posts, do_resize, do_xmp, output_folder)
 
 
 # ============================================================
@@ -683,8 +1236,8 @@ def create_ui():
             "**除外タグ**: `-tag` で除外 (例: `1girl blue_hair -comic`)"
         )
 
-        posts_state = gr.State("")
-        selected_state = gr.State("[]")
+        posts_state = gr.State([])  # 検索結果の投稿リスト
+        selected_state = gr.State(set())  # 選択中の投稿インデックス
         page_state = gr.State(0)  # 現在のページ (0-indexed)
 
         with gr.Row():
@@ -748,7 +1301,7 @@ def create_ui():
             page_info = gr.Markdown(value="ページ 0 / 0")
             next_page_btn = gr.Button("次ページ ▶", size="sm")
 
-        selected_info = gr.Markdown(value="選択: 0 / 0 件")
+        selected_info = gr.Markdown(value=_format_selected_info(0, 0))
 
         gr.Markdown("---")
         gr.Markdown("### ダウンロード設定")
@@ -773,8 +1326,7 @@ def create_ui():
 
         # --- タグ数バリデーション ---
         def validate_tags(text):
-            include = [t for t in text.strip().split() if not t.startswith("-")]
-            count = len(include)
+            count = _count_include_tags(text)
             if count >= 3:
                 return (
                     gr.update(interactive=True),
@@ -792,34 +1344,34 @@ def create_ui():
                     ),
                 )
 
+        # 入力中は実行中の検証が終わるまで後続をまとめ、最後の入力だけ検証する
         tags_input.change(
             fn=validate_tags,
             inputs=[tags_input],
             outputs=[search_btn, tag_warning],
+            trigger_mode="always_last",
+            show_progress="hidden",
         )
 
         # --- チェックボックス変更時: 選択状態を反映 ---
-        def on_checkbox_change(
-            slot_idx, checked, selected_json, posts_json, current_page
-        ):
-            selected = set(json.loads(selected_json)) if selected_json else set()
-            posts = json.loads(posts_json) if posts_json else []
+        def on_checkbox_change(slot_idx, checked, selected, posts, current_page):
             global_idx = current_page * PREVIEW_PER_PAGE + slot_idx
+            n_before = len(selected)
             if global_idx < len(posts):
                 if checked:
                     selected.add(global_idx)
                 else:
                     selected.discard(global_idx)
-            total = len(posts)
-            info = f"**選択: {len(selected)} / {total} 件**"
-            if len(selected) > 0:
-                info += " — ダウンロード可能"
-            return json.dumps(sorted(selected)), info
+            # ページ切り替えでチェック状態を書き戻した時などは件数が変わらない
+            # → 表示は更新しない
+            if len(selected) == n_before:
+                return selected, gr.update()
+            return selected, _format_selected_info(len(selected), len(posts))
 
         for slot_i, cb in enumerate(check_slots):
             cb.change(
-                fn=lambda checked, sj, pj, cp, _i=slot_i: on_checkbox_change(
-                    _i, checked, sj, pj, cp
+                fn=lambda checked, sel, posts, cp, _i=slot_i: on_checkbox_change(
+                    _i, checked, sel, posts, cp
                 ),
                 inputs=[cb, selected_state, posts_state, page_state],
                 outputs=[selected_state, selected_info],
@@ -833,13 +1385,13 @@ def create_ui():
             page_grid_outputs.append(cb)
 
         prev_page_btn.click(
-            fn=lambda pj, sj, cp: do_page_change(pj, sj, cp, -1),
+            fn=lambda posts, sel, cp: do_page_change(posts, sel, cp, -1),
             inputs=[posts_state, selected_state, page_state],
             outputs=[page_state, page_info] + page_grid_outputs,
         )
 
         next_page_btn.click(
-            fn=lambda pj, sj, cp: do_page_change(pj, sj, cp, +1),
+            fn=lambda posts, sel, cp: do_page_change(posts, sel, cp, +1),
             inputs=[posts_state, selected_state, page_state],
             outputs=[page_state, page_info] + page_grid_outputs,
         )